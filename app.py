@@ -4,6 +4,7 @@ FastAPI приложение для обработки webhook'ов Stars Paymen
 Поддерживает несколько токенов из таблицы stars_bot_tokens
 """
 import asyncio
+import hmac
 import logging
 import os
 import sys
@@ -15,8 +16,9 @@ from typing import Dict
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.types import Update
-from fastapi import FastAPI, HTTPException, Header, Depends, Query
+from fastapi import FastAPI, HTTPException, Header, Depends, Query, Request
 from fastapi.responses import JSONResponse
+from pydantic import ValidationError
 from dotenv import load_dotenv
 
 PROJECT_ROOT = Path(__file__).resolve().parent
@@ -28,12 +30,13 @@ else:
 
 sys.path.insert(0, str(PROJECT_ROOT))
 
-from stars_bot.database.operations import close_pool, get_pool
-from stars_bot.config.settings import Settings
+from stars_bot.database.operations import close_pool, ensure_schema, get_pool
+from stars_bot.config.settings import Settings, get_settings
 from stars_bot.models import StarsBotToken
+from stars_bot.outbox import outbox
 from stars_bot.utils import get_stars_amount_for_credits
 
-from stars_bot import handlers, services
+from stars_bot import handlers, services, transport
 
 logger = logging.getLogger(__name__)
 
@@ -44,28 +47,45 @@ logging.basicConfig(
 )
 
 WEBHOOK_URL = os.getenv("STARS_WEBHOOK_URL")
+# Префикс webhook пути (неизменен, собираем один раз)
+_WEBHOOK_PREFIX = f"{WEBHOOK_URL}/stars/" if WEBHOOK_URL else None
 
 bots_registry: Dict[int, tuple[Bot, Dispatcher]] = {}
 
+# Задачи обработки update'ов, запущенные в фоне (держим ссылки, чтобы их не собрал GC)
+_update_tasks: set[asyncio.Task] = set()
 
-async def setup_single_bot(token_record: StarsBotToken, proxy_url: str | None = None) -> tuple[Bot, Dispatcher]:
+
+def _on_update_task_done(task: asyncio.Task) -> None:
+    """Логирует ошибку фоновой обработки update и убирает задачу из набора"""
+    _update_tasks.discard(task)
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        logger.error(f"Ошибка обработки update: {exc}", exc_info=exc)
+
+
+async def setup_single_bot(token_record: StarsBotToken) -> tuple[Bot, Dispatcher]:
     """Настраивает одного бота. Возвращает (bot, dp)"""
     token_id = token_record.id
     token = token_record.token
-    token_preview = token[:8] if token else "unknown"
+    token_preview = token_record.token_preview
 
     try:
         bot = Bot(
             token=token,
+            # Общая сессия Telegram (лимиты пула и прокси из Settings)
+            session=transport.get_telegram_session(),
             default=DefaultBotProperties(parse_mode="HTML"),
         )
 
         # Используем глобальный dispatcher из handlers
         dp = handlers.dp
 
-        if not WEBHOOK_URL:
+        if not _WEBHOOK_PREFIX:
             raise ValueError("STARS_WEBHOOK_URL не настроен для webhook режима")
-        webhook_path = f"{WEBHOOK_URL}/stars/{token_id}"
+        webhook_path = _WEBHOOK_PREFIX + str(token_id)
         await bot.set_webhook(
             url=webhook_path,
             drop_pending_updates=True,
@@ -73,12 +93,13 @@ async def setup_single_bot(token_record: StarsBotToken, proxy_url: str | None =
         )
         logger.info(f"✅ Webhook установлен для токена {token_preview}... (ID: {token_id}): {webhook_path}")
 
-        # Проверяем, что webhook действительно установлен
-        webhook_info = await bot.get_webhook_info()
-        if webhook_info.url == webhook_path:
-            logger.info(f"✅ Webhook подтверждён для токена {token_preview}... (ID: {token_id}): {webhook_info.url}")
-        else:
-            logger.warning(f"⚠️ Webhook URL не совпадает для токена {token_preview}... (ID: {token_id})! Ожидалось: {webhook_path}, получено: {webhook_info.url}")
+        # set_webhook сам сообщает об ошибке; дополнительная проверка (лишний запрос к API) только в DEV
+        if get_settings().environment == "DEV":
+            webhook_info = await bot.get_webhook_info()
+            if webhook_info.url == webhook_path:
+                logger.info(f"✅ Webhook подтверждён для токена {token_preview}... (ID: {token_id}): {webhook_info.url}")
+            else:
+                logger.warning(f"⚠️ Webhook URL не совпадает для токена {token_preview}... (ID: {token_id})! Ожидалось: {webhook_path}, получено: {webhook_info.url}")
 
         bots_registry[token_id] = (bot, dp)
         return bot, dp
@@ -89,9 +110,6 @@ async def setup_single_bot(token_record: StarsBotToken, proxy_url: str | None =
 
 
 async def setup_all_bots() -> None:
-    settings = Settings.load()
-    proxy_url = settings.get_proxy_url()
-    
     active_tokens = await services.get_active_stars_bot_tokens()
     
     if not active_tokens:
@@ -105,39 +123,51 @@ async def setup_all_bots() -> None:
     logger.info(f"✅ Найдено {len(active_tokens)} активных токенов в БД")
     
     tasks = [
-        asyncio.create_task(setup_single_bot(token_record, proxy_url))
+        asyncio.create_task(setup_single_bot(token_record))
         for token_record in active_tokens
     ]
     
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    
+    # Обрабатываем результаты по мере готовности ботов, не дожидаясь самого медленного
     success_count = 0
-    for idx, result in enumerate(results):
-        if isinstance(result, Exception):
-            token_preview = active_tokens[idx].token[:8] if idx < len(active_tokens) else "unknown"
-            logger.error(f"❌ Бот с токеном {token_preview}... не настроен: {result}")
-        else:
+    for next_done in asyncio.as_completed(tasks):
+        try:
+            await next_done
             success_count += 1
+        except Exception as e:
+            # Токен бота уже залогирован в setup_single_bot
+            logger.error(f"❌ Бот не настроен: {e}")
     
     logger.info(f"🚀 Настроено {success_count} из {len(active_tokens)} ботов")
 
 
+async def _shutdown_single_bot(token_id: int, bot: Bot) -> None:
+    """Удаляет webhook одного бота"""
+    try:
+        await bot.delete_webhook()
+        logger.info(f"✅ Webhook удалён для бота ID: {token_id}")
+    except Exception as e:
+        logger.error(f"❌ Ошибка удаления webhook для бота ID {token_id}: {e}")
+
+
 async def cleanup_all_bots() -> None:
-    for token_id, (bot, _) in bots_registry.items():
-        try:
-            await bot.delete_webhook()
-            await bot.session.close()
-            logger.info(f"✅ Webhook удалён для бота ID: {token_id}")
-        except Exception as e:
-            logger.error(f"❌ Ошибка удаления webhook для бота ID {token_id}: {e}")
+    tasks = [
+        asyncio.create_task(_shutdown_single_bot(token_id, bot))
+        for token_id, (bot, _) in bots_registry.items()
+    ]
+    await asyncio.gather(*tasks, return_exceptions=True)
     
+    # Общая сессия Telegram нужна и после переустановки webhook'ов — закрывается только при остановке
     bots_registry.clear()
+    services.invalidate_active_stars_bot_tokens()
+    transport.invalidate_bot()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await get_pool()
     logger.info("Database connection pool initialized")
+    await ensure_schema()
+    logger.info("Database schema ensured")
     
     try:
         await setup_all_bots()
@@ -148,8 +178,13 @@ async def lifespan(app: FastAPI):
     
     yield
     
-    # Очистка при остановке
+    # Очистка при остановке: дожидаемся обработки уже принятых update'ов
+    if _update_tasks:
+        await asyncio.gather(*_update_tasks, return_exceptions=True)
+    await handlers.delete_scheduler.stop()
+    await outbox.stop()
     await cleanup_all_bots()
+    await transport.close_telegram_session()
     await close_pool()
     logger.info("Database connection pool closed")
 
@@ -157,18 +192,6 @@ async def lifespan(app: FastAPI):
 app = FastAPI(lifespan=lifespan)
 
 
-# Кэш для настроек
-_settings_cache: Settings | None = None
-
-
-def get_settings() -> Settings:
-    """Получает настройки (с кэшированием)"""
-    global _settings_cache
-    if _settings_cache is None:
-        _settings_cache = Settings.load()
-    return _settings_cache
-
-
 async def verify_admin_token(
     x_admin_token: str | None = Header(None, alias="X-Admin-Token"),
     admin_token: str | None = Query(None, alias="admin_token"),
@@ -196,7 +219,7 @@ async def verify_admin_token(
             detail="Требуется заголовок X-Admin-Token или query параметр admin_token"
         )
     
-    if provided_token != settings.admin_token:
+    if not hmac.compare_digest(provided_token.encode(), settings.admin_token_bytes):
         logger.warning(f"Попытка доступа с невалидным токеном: {provided_token[:8]}...")
         raise HTTPException(
             status_code=403,
@@ -205,21 +228,29 @@ async def verify_admin_token(
 
 
 @app.post("/stars/{token_id}")
-async def handle_webhook(token_id: int, update: Update):
+async def handle_webhook(token_id: int, request: Request):
     """Обработка webhook'ов от Telegram для Stars Payment Bot по token_id"""
-    if token_id not in bots_registry:
+    entry = bots_registry.get(token_id)
+    if entry is None:
         logger.warning(f"Бот с token_id={token_id} не найден в реестре")
         return JSONResponse({"ok": True})
     
-    bot, dp = bots_registry[token_id]
+    bot, dp = entry
     
+    # Разбираем тело сразу в Update, привязанный к боту: без промежуточного dict
+    # и без повторной валидации (model_dump -> model_validate) внутри feed_update
+    body = await request.body()
     try:
-        await dp.feed_update(bot=bot, update=update)
-        return JSONResponse({"ok": True}, status_code=200)
-    except Exception as e:
-        logger.error(f"Ошибка обработки update для бота token_id={token_id}: {e}", exc_info=True)
-        # Всегда возвращаем 200 OK для Telegram, чтобы не было повторных запросов
-        return JSONResponse({"ok": False, "error": "Internal server error"}, status_code=200)
+        update = Update.model_validate_json(body, context={"bot": bot})
+    except ValidationError as e:
+        logger.warning(f"Невалидный update для бота token_id={token_id}: {e}")
+        return JSONResponse({"ok": False, "error": "Invalid update"}, status_code=200)
+    
+    # Обрабатываем update в фоне и сразу отвечаем Telegram 200 OK, чтобы не было повторных запросов
+    task = asyncio.create_task(dp.feed_update(bot=bot, update=update))
+    _update_tasks.add(task)
+    task.add_done_callback(_on_update_task_done)
+    return JSONResponse({"ok": True}, status_code=200)
 
 
 @app.get("/")
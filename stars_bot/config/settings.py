@@ -1,10 +1,28 @@
 """Configuration settings for Stars Payment Bot"""
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from functools import lru_cache
 from pathlib import Path
 from dotenv import load_dotenv
 
 
+_dotenv_loaded = False
+
+
+def _load_dotenv_once() -> None:
+    """Загружает .env один раз за процесс"""
+    global _dotenv_loaded
+    if _dotenv_loaded:
+        return
+    project_root = Path(__file__).resolve().parents[2]
+    dotenv_path = project_root / ".env"
+    if dotenv_path.exists():
+        load_dotenv(dotenv_path=dotenv_path)
+    else:
+        load_dotenv()
+    _dotenv_loaded = True
+
+
 def _env(key: str, default: str | None = None) -> str | None:
     val = os.getenv(key)
     return val if val is not None else default
@@ -22,6 +40,16 @@ class Settings:
     environment: str = "DEV"  # "DEV" или "PROD"
     main_app_url: str | None = None  # URL основного приложения для уведомлений
     admin_token: str | None = None  # Токен для защиты admin эндпоинтов
+    admin_token_bytes: bytes | None = field(default=None, init=False, repr=False)  # admin_token для hmac.compare_digest
+    # Общий пул соединений к Telegram Bot API (все боты процесса)
+    telegram_conn_limit: int = 200
+    telegram_conn_limit_per_host: int = 100
+    telegram_dns_cache_ttl: int = 300  # секунд
+    telegram_keepalive_timeout: float = 75  # секунд
+
+    def __post_init__(self) -> None:
+        if self.admin_token:
+            self.admin_token_bytes = self.admin_token.encode()
 
     def get_proxy_url(self) -> str | None:
         # Проверяем, отключен ли прокси через переменную окружения
@@ -48,13 +76,7 @@ class Settings:
 
     @staticmethod
     def load() -> "Settings":
-        project_root = Path(__file__).resolve().parents[2]
-        dotenv_path = project_root / ".env"
-        if dotenv_path.exists():
-            load_dotenv(dotenv_path=dotenv_path)
-        else:
-            load_dotenv()
-        
+        _load_dotenv_once()
         return Settings(
             # Новый формат прокси (приоритет)
             proxy_user=_env("PROXY_USER"),
@@ -69,5 +91,15 @@ class Settings:
             main_app_url=_env("MAIN_APP_URL", None),
             # Admin token для защиты эндпоинтов
             admin_token=_env("ADMIN_TOKEN", None),
+            # Лимиты пула соединений к Telegram
+            telegram_conn_limit=int(_env("TELEGRAM_CONN_LIMIT", "200")),
+            telegram_conn_limit_per_host=int(_env("TELEGRAM_CONN_LIMIT_PER_HOST", "100")),
+            telegram_dns_cache_ttl=int(_env("TELEGRAM_DNS_CACHE_TTL", "300")),
+            telegram_keepalive_timeout=float(_env("TELEGRAM_KEEPALIVE_TIMEOUT", "75")),
         )
 
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Получает настройки (с кэшированием, один экземпляр на процесс)"""
+    return Settings.load()
@@ -18,7 +18,53 @@ else:
     load_dotenv()
 
 _pool: Optional[asyncpg.Pool] = None
-_payments_usd_columns_ensured = False
+
+# Миграция USD колонок таблицы payments (выполняется одним запросом при старте)
+_SCHEMA_SQL = """
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS net_amount_usd REAL;
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS gross_amount_usd REAL;
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS fee_amount_usd REAL;
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS expected_net_amount_usd REAL;
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS expected_gross_amount_usd REAL;
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS expected_fee_amount_usd REAL;
+"""
+
+# Тексты горячих запросов. asyncpg кэширует prepared statement на соединении по тексту запроса,
+# поэтому одинаковые запросы держим в одном месте: parse/plan выполняется один раз на соединение
+_SELECT_PAYMENT_SQL = """
+SELECT id, user_id, amount, status, payment_provider, bot_owner_id, bot_id, created_at
+FROM payments
+"""
+_GET_PAYMENT_BY_ID_SQL = _SELECT_PAYMENT_SQL + "WHERE id = $1"
+_GET_PAYMENT_BY_EXTERNAL_ID_SQL = _SELECT_PAYMENT_SQL + "WHERE external_payment_id = $1 AND payment_provider = $2"
+_GET_LANG_SQL = "SELECT lang FROM users WHERE user_id=$1"
+_GET_TOKEN_ID_BY_TOKEN_SQL = "SELECT id FROM stars_bot_tokens WHERE token = $1 AND is_active = TRUE"
+# Статус не перезаписывается, если он уже равен целевому (без блокировки строки и записи в WAL).
+# В том же запросе проверяем существование платежа: true — платеж есть (обновлен или уже в статусе)
+_UPDATE_PAYMENT_STATUS_BY_ID_SQL = """
+WITH upd AS (
+    UPDATE payments
+    SET status = $1, updated_at = NOW()
+    WHERE id = $2 AND status IS DISTINCT FROM $1
+    RETURNING 1
+)
+SELECT EXISTS(SELECT 1 FROM payments WHERE id = $2)
+"""
+_UPDATE_PAYMENT_STATUS_BY_EXTERNAL_SQL = """
+WITH upd AS (
+    UPDATE payments
+    SET status = $1, updated_at = NOW()
+    WHERE external_payment_id = $2 AND payment_provider = $3 AND status IS DISTINCT FROM $1
+    RETURNING 1
+)
+SELECT EXISTS(SELECT 1 FROM payments WHERE external_payment_id = $2 AND payment_provider = $3)
+"""
+
+# Создает пользователя, если его нет, и добавляет к балансу одним запросом
+_ADD_BALANCE_SQL = """
+INSERT INTO users(user_id, balance) VALUES($1, $2)
+ON CONFLICT(user_id) DO UPDATE SET balance = COALESCE(users.balance, 0) + EXCLUDED.balance
+"""
 
 
 async def get_pool() -> asyncpg.Pool:
@@ -31,9 +77,13 @@ async def get_pool() -> asyncpg.Pool:
             database=os.getenv("DB_NAME", "refbot"),
             user=os.getenv("DB_USER", "postgres"),
             password=os.getenv("DB_PASSWORD", ""),
-            min_size=2,
-            max_size=10,
+            min_size=int(os.getenv("DB_POOL_MIN", "10")),
+            max_size=int(os.getenv("DB_POOL_MAX", "50")),
+            max_inactive_connection_lifetime=300,
+            statement_cache_size=1024,
             command_timeout=30,
+            # JIT не окупается на коротких запросах бота
+            server_settings={"jit": "off"},
         )
     return _pool
 
@@ -46,36 +96,19 @@ async def close_pool() -> None:
         _pool = None
 
 
-async def _ensure_payments_usd_columns() -> None:
-    """Обеспечивает наличие USD колонок в таблице payments"""
-    global _payments_usd_columns_ensured
-    if _payments_usd_columns_ensured:
-        return
-
+async def ensure_schema() -> None:
+    """Обеспечивает наличие USD колонок в таблице payments. Вызывается один раз при старте приложения"""
     pool = await get_pool()
     async with pool.acquire() as conn:
         async with conn.transaction():
-            await conn.execute("ALTER TABLE payments ADD COLUMN IF NOT EXISTS net_amount_usd REAL")
-            await conn.execute("ALTER TABLE payments ADD COLUMN IF NOT EXISTS gross_amount_usd REAL")
-            await conn.execute("ALTER TABLE payments ADD COLUMN IF NOT EXISTS fee_amount_usd REAL")
-            await conn.execute("ALTER TABLE payments ADD COLUMN IF NOT EXISTS expected_net_amount_usd REAL")
-            await conn.execute("ALTER TABLE payments ADD COLUMN IF NOT EXISTS expected_gross_amount_usd REAL")
-            await conn.execute("ALTER TABLE payments ADD COLUMN IF NOT EXISTS expected_fee_amount_usd REAL")
-    _payments_usd_columns_ensured = True
+            await conn.execute(_SCHEMA_SQL)
 
 
 async def db_get_payment_row_by_id(payment_id: int):
     """Возвращает строку платежа по ID (для Telegram Stars)"""
     pool = await get_pool()
     async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            """
-            SELECT id, user_id, amount, status, payment_provider, bot_owner_id, bot_id, created_at
-            FROM payments
-            WHERE id = $1
-            """,
-            payment_id,
-        )
+        row = await conn.fetchrow(_GET_PAYMENT_BY_ID_SQL, payment_id)
         return row
 
 
@@ -83,15 +116,7 @@ async def db_get_payment_row_by_external_id(external_payment_id: str, payment_pr
     """Возвращает строку платежа по external_payment_id и payment_provider"""
     pool = await get_pool()
     async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            """
-            SELECT id, user_id, amount, status, payment_provider, bot_owner_id, bot_id, created_at
-            FROM payments
-            WHERE external_payment_id = $1 AND payment_provider = $2
-            """,
-            external_payment_id,
-            payment_provider,
-        )
+        row = await conn.fetchrow(_GET_PAYMENT_BY_EXTERNAL_ID_SQL, external_payment_id, payment_provider)
         return row
 
 
@@ -105,18 +130,6 @@ async def db_list_active_stars_bot_tokens_rows():
         return rows
 
 
-async def db_pick_random_active_stars_bot_token():
-    """Возвращает случайный активный токен, token_id и username Stars Payment Bot"""
-    pool = await get_pool()
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT id, token, bot_username FROM stars_bot_tokens WHERE is_active = TRUE ORDER BY RANDOM() LIMIT 1"
-        )
-        if not row:
-            return None
-        return row["token"], row["id"], row["bot_username"]
-
-
 async def db_get_stars_bot_token_by_id(token_id: int) -> Optional[tuple[str, Optional[str]]]:
     """Возвращает токен и username Stars Payment Bot по token_id"""
     pool = await get_pool()
@@ -127,20 +140,17 @@ async def db_get_stars_bot_token_by_id(token_id: int) -> Optional[tuple[str, Opt
         )
         if not row:
             return None
-        return row["token"], row["bot_username"]
+        return row[0], row[1]
 
 
 async def db_get_stars_bot_token_id_by_token(token: str) -> Optional[int]:
     """Возвращает token_id по токену бота"""
     pool = await get_pool()
     async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT id FROM stars_bot_tokens WHERE token = $1 AND is_active = TRUE",
-            token,
-        )
+        row = await conn.fetchrow(_GET_TOKEN_ID_BY_TOKEN_SQL, token)
         if not row:
             return None
-        return row["id"]
+        return row[0]
 
 
 async def db_update_payment_stars_bot_token_id(payment_id: int, token_id: int) -> None:
@@ -153,7 +163,7 @@ async def db_update_payment_stars_bot_token_id(payment_id: int, token_id: int) -
             SET bot_id = $1
             WHERE id = $2
             """,
-            f"stars_token_{token_id}",
+            "stars_token_%d" % token_id,
             payment_id,
         )
 
@@ -166,10 +176,10 @@ async def db_get_payment_stars_bot_token_id(payment_id: int) -> Optional[int]:
             "SELECT bot_id FROM payments WHERE id = $1",
             payment_id,
         )
-        if not row or not row["bot_id"]:
+        if not row or not row[0]:
             return None
         
-        bot_id_str = str(row["bot_id"])
+        bot_id_str = str(row[0])
         if bot_id_str.startswith("stars_token_"):
             try:
                 return int(bot_id_str.replace("stars_token_", ""))
@@ -182,9 +192,9 @@ async def db_get_lang(user_id: int) -> Optional[str]:
     """Получает язык пользователя (быстрый запрос только языка). Возвращает None если язык не установлен."""
     pool = await get_pool()
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT lang FROM users WHERE user_id=$1", user_id)
-        if row and row["lang"]:
-            lang = str(row["lang"]).strip().lower()
+        row = await conn.fetchrow(_GET_LANG_SQL, user_id)
+        if row and row[0]:
+            lang = str(row[0]).strip().lower()
             # Проверяем, что язык валидный (после приведения к нижнему регистру)
             if lang in ["ru", "en", "zh"]:
                 return lang
@@ -195,49 +205,30 @@ async def db_create_payment(user_id: int, amount: int, payment_provider: str = "
     """Создает новый платеж в БД. Возвращает payment_id"""
     pool = await get_pool()
     async with pool.acquire() as conn:
-        async with conn.transaction():
-            row = await conn.fetchrow(
-                """
-                INSERT INTO payments (user_id, amount, status, payment_provider, bot_owner_id, bot_id, created_at)
-                VALUES ($1, $2, 'pending', $3, $4, $5, NOW())
-                RETURNING id
-                """,
-                user_id,
-                amount,
-                payment_provider,
-                bot_owner_id,
-                bot_id,
-            )
-            payment_id = row["id"]
-            
-            external_payment_id = f"stars_{payment_id}"
-            await conn.execute(
-                """
-                UPDATE payments
-                SET external_payment_id = $1
-                WHERE id = $2
-                """,
-                external_payment_id,
-                payment_id,
+        # id берём из последовательности заранее, чтобы external_payment_id записать тем же INSERT
+        row = await conn.fetchrow(
+            """
+            WITH next_id AS (SELECT nextval(pg_get_serial_sequence('payments', 'id')) AS id)
+            INSERT INTO payments (id, user_id, amount, status, payment_provider, bot_owner_id, bot_id, external_payment_id, created_at)
+            VALUES (
+                (SELECT id FROM next_id), $1, $2, 'pending', $3, $4, $5, 'stars_' || (SELECT id FROM next_id), NOW()
             )
-            
-            return payment_id
+            RETURNING id
+            """,
+            user_id,
+            amount,
+            payment_provider,
+            bot_owner_id,
+            bot_id,
+        )
+        return row[0]
 
 
 async def db_add_credits(user_id: int, delta: int) -> None:
     """Добавляет кредиты пользователю"""
     pool = await get_pool()
     async with pool.acquire() as conn:
-        async with conn.transaction():
-            await conn.execute(
-                "INSERT INTO users(user_id, balance) VALUES($1,0) ON CONFLICT(user_id) DO NOTHING",
-                user_id,
-            )
-            await conn.execute(
-                "UPDATE users SET balance = COALESCE(balance, 0) + $1 WHERE user_id=$2",
-                delta,
-                user_id,
-            )
+        await conn.execute(_ADD_BALANCE_SQL, user_id, delta)
 
 
 async def db_add_referral_bonus(user_id: int, amount: int, bot_owner_id: Optional[int] = None, ref_percent: float = 0.05) -> bool:
@@ -252,18 +243,8 @@ async def db_add_referral_bonus(user_id: int, amount: int, bot_owner_id: Optiona
     try:
         pool = await get_pool()
         async with pool.acquire() as conn:
-            async with conn.transaction():
-                # Создаем пользователя-владельца бота, если его нет
-                await conn.execute(
-                    "INSERT INTO users(user_id, balance) VALUES($1, 0) ON CONFLICT(user_id) DO NOTHING",
-                    bot_owner_id,
-                )
-                # Начисляем бонус
-                await conn.execute(
-                    "UPDATE users SET balance = COALESCE(balance, 0) + $1 WHERE user_id=$2",
-                    bonus,
-                    bot_owner_id,
-                )
+            # Создаем пользователя-владельца бота, если его нет, и начисляем бонус
+            await conn.execute(_ADD_BALANCE_SQL, bot_owner_id, bonus)
         return True
     except Exception as e:
         logger.error(f"db_add_referral_bonus failed: {e}", exc_info=True)
@@ -275,16 +256,15 @@ async def db_update_referral_status(referred_id: int, status: str) -> bool:
     try:
         pool = await get_pool()
         async with pool.acquire() as conn:
-            async with conn.transaction():
-                await conn.execute(
-                    """
-                    UPDATE referrals
-                    SET status = $1, updated_at = NOW()
-                    WHERE referred_id = $2
-                    """,
-                    status,
-                    referred_id,
-                )
+            await conn.execute(
+                """
+                UPDATE referrals
+                SET status = $1, updated_at = NOW()
+                WHERE referred_id = $2
+                """,
+                status,
+                referred_id,
+            )
         return True
     except Exception as e:
         logger.error(f"db_update_referral_status failed: {e}", exc_info=True)
@@ -296,20 +276,10 @@ async def db_update_payment_status_by_id(payment_id: int, status: str) -> bool:
     try:
         pool = await get_pool()
         async with pool.acquire() as conn:
-            async with conn.transaction():
-                result = await conn.execute(
-                    """
-                    UPDATE payments
-                    SET status = $1, updated_at = NOW()
-                    WHERE id = $2
-                    """,
-                    status,
-                    payment_id,
-                )
-                # Проверяем, были ли обновлены строки
-                if result == "UPDATE 0":
-                    logger.warning(f"Не найдено платежей для обновления: payment_id={payment_id}")
-                    return False
+            exists = await conn.fetchval(_UPDATE_PAYMENT_STATUS_BY_ID_SQL, status, payment_id)
+        if not exists:
+            logger.warning(f"Не найдено платежей для обновления: payment_id={payment_id}")
+            return False
         return True
     except Exception as e:
         logger.error(f"Ошибка обновления статуса платежа по payment_id: {e}", exc_info=True)
@@ -321,51 +291,59 @@ async def db_update_payment_status_by_external(external_payment_id: str, payment
     try:
         pool = await get_pool()
         async with pool.acquire() as conn:
-            async with conn.transaction():
-                result = await conn.execute(
-                    """
-                    UPDATE payments
-                    SET status = $1, updated_at = NOW()
-                    WHERE external_payment_id = $2 AND payment_provider = $3
-                    """,
-                    status,
-                    external_payment_id,
-                    payment_provider,
-                )
-                if result == "UPDATE 0":
-                    logger.warning(f"Не найдено платежей для обновления: external_id={external_payment_id}, provider={payment_provider}")
-                    return False
+            exists = await conn.fetchval(
+                _UPDATE_PAYMENT_STATUS_BY_EXTERNAL_SQL,
+                status,
+                external_payment_id,
+                payment_provider,
+            )
+        if not exists:
+            logger.warning(f"Не найдено платежей для обновления: external_id={external_payment_id}, provider={payment_provider}")
+            return False
         return True
     except Exception as e:
         logger.error(f"Ошибка обновления статуса платежа по external_id: {e}", exc_info=True)
         return False
 
 
-async def db_update_payment_usd_breakdown(
+async def db_finalize_payment(
     payment_id: int,
+    user_id: int,
+    amount: int,
     net_amount_usd: Optional[float],
     gross_amount_usd: Optional[float],
     fee_amount_usd: Optional[float],
-) -> None:
-    """Обновляет USD значения платежа"""
-    try:
-        await _ensure_payments_usd_columns()
-        pool = await get_pool()
-        async with pool.acquire() as conn:
-            async with conn.transaction():
-                await conn.execute(
-                    """
-                    UPDATE payments
-                    SET net_amount_usd = $1,
-                        gross_amount_usd = $2,
-                        fee_amount_usd = $3,
-                        updated_at = NOW()
-                    WHERE id = $4
-                    """,
-                    net_amount_usd,
-                    gross_amount_usd,
-                    fee_amount_usd,
-                    payment_id,
-                )
-    except Exception as e:
-        logger.error(f"Ошибка обновления USD-данных платежа: {e}", exc_info=True)
+) -> bool:
+    """
+    Проводит успешный платеж одним запросом: статус completed + USD значения и начисление кредитов.
+    Возвращает False, если платеж уже был в статусе completed (ничего не начисляется).
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        # Кредиты начисляются только если UPDATE действительно перевел платеж в completed:
+        # повторная обработка того же платежа не вернет строку из CTE и ничего не вставит
+        credited_user_id = await conn.fetchval(
+            """
+            WITH completed AS (
+                UPDATE payments
+                SET status = 'completed',
+                    net_amount_usd = $2,
+                    gross_amount_usd = $3,
+                    fee_amount_usd = $4,
+                    updated_at = NOW()
+                WHERE id = $1 AND status IS DISTINCT FROM 'completed'
+                RETURNING id
+            )
+            INSERT INTO users(user_id, balance)
+            SELECT $5, $6 FROM completed
+            ON CONFLICT(user_id) DO UPDATE SET balance = COALESCE(users.balance, 0) + EXCLUDED.balance
+            RETURNING user_id
+            """,
+            payment_id,
+            net_amount_usd,
+            gross_amount_usd,
+            fee_amount_usd,
+            user_id,
+            amount,
+        )
+    return credited_user_id is not None
@@ -2,30 +2,42 @@
 Обработчики для Stars Payment Bot
 """
 import asyncio
+import heapq
+import itertools
 import logging
 from typing import Any, Awaitable, Callable
 
+import asyncpg
 from aiogram import Bot, BaseMiddleware, Dispatcher, F
+from aiogram.exceptions import TelegramAPIError
 from aiogram.filters import Command
 from aiogram.types import Message, PreCheckoutQuery, CallbackQuery, TelegramObject
 
 from stars_bot.database.operations import db_get_stars_bot_token_id_by_token
 from stars_bot.notifications import notify_user_payment_success
-from stars_bot.ui.translations import tr
+from stars_bot.outbox import outbox
+from stars_bot.ui.translations import SUPPORTED_LANGS, get_template, tr
 
 from . import services, transport
 from .keyboards import (
+    CREDITS_TO_STARS,
     build_payment_inline_keyboard,
     build_payment_menu_keyboard,
     build_topup_keyboard,
-    get_stars_for_credits,
 )
-from .models import MESSAGE_DELETE_DELAY
+from .models import MESSAGE_DELETE_DELAY, PaymentRecord
+from .utils import get_stars_amount_for_credits
 
 logger = logging.getLogger(__name__)
 
 dp = Dispatcher()
 
+# Тексты кнопки 'Меню оплаты' на всех языках
+_MENU_BUTTON_TEXTS: frozenset[str] = frozenset(tr(lang, "btn_payment_menu") for lang in SUPPORTED_LANGS)
+
+# token бота -> token_id (соответствие не меняется за время жизни процесса)
+_token_id_cache: dict[str, int] = {}
+
 
 class TokenIdMiddleware(BaseMiddleware):
     """Middleware для сохранения token_id в event data"""
@@ -38,7 +50,11 @@ class TokenIdMiddleware(BaseMiddleware):
     ) -> Any:
         bot: Bot = data.get("bot")
         if bot and bot.token:
-            token_id = await db_get_stars_bot_token_id_by_token(bot.token)
+            token_id = _token_id_cache.get(bot.token)
+            if token_id is None:
+                token_id = await db_get_stars_bot_token_id_by_token(bot.token)
+                if token_id:
+                    _token_id_cache[bot.token] = token_id
             if token_id:
                 data["token_id"] = token_id
                 logger.debug(f"Token ID {token_id} сохранен в event data")
@@ -46,19 +62,103 @@ class TokenIdMiddleware(BaseMiddleware):
         return await handler(event, data)
 
 
-dp.message.middleware(TokenIdMiddleware())
-dp.callback_query.middleware(TokenIdMiddleware())
-dp.pre_checkout_query.middleware(TokenIdMiddleware())
+# Один раз на update (данные из outer middleware доступны всем обработчикам)
+dp.update.outer_middleware(TokenIdMiddleware())
+
+DELETE_MESSAGES_BATCH_SIZE = 100  # лимит Bot API deleteMessages
+
+
+class DeleteScheduler:
+    """Отложенное удаление сообщений: одна фоновая задача и heap по времени удаления вместо задачи на каждое сообщение"""
+
+    def __init__(self) -> None:
+        # (deadline по loop.time(), порядковый номер, bot, chat_id, message_id)
+        self._heap: list[tuple[float, int, Bot, int, int]] = []
+        self._counter = itertools.count()
+        self._wakeup: asyncio.Event | None = None
+        self._worker: asyncio.Task | None = None
+
+    def schedule(self, deadline: float, bot: Bot, chat_id: int, message_id: int) -> None:
+        """Планирует удаление сообщения в момент deadline (по часам event loop)"""
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+        heapq.heappush(self._heap, (deadline, next(self._counter), bot, chat_id, message_id))
+        # Будим воркер, только если новое удаление стало ближайшим
+        if self._heap[0][0] == deadline:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Забираем все наступившие удаления и группируем по (бот, чат)
+            now = loop.time()
+            batches: dict[tuple[int, int], tuple[Bot, list[int]]] = {}
+            while self._heap and self._heap[0][0] <= now:
+                _, _, bot, chat_id, message_id = heapq.heappop(self._heap)
+                batches.setdefault((id(bot), chat_id), (bot, []))[1].append(message_id)
+
+            for (_, chat_id), (bot, message_ids) in batches.items():
+                for i in range(0, len(message_ids), DELETE_MESSAGES_BATCH_SIZE):
+                    await self._delete(bot, chat_id, message_ids[i:i + DELETE_MESSAGES_BATCH_SIZE])
+
+    @staticmethod
+    async def _delete(bot: Bot, chat_id: int, message_ids: list[int]) -> None:
+        """Удаляет сообщения одним запросом deleteMessages, при ошибке API — по одному"""
+        if len(message_ids) > 1:
+            try:
+                await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+                logger.debug("Сообщения %s в чате %s удалены по расписанию", message_ids, chat_id)
+                return
+            except Exception as e:
+                logger.debug("deleteMessages не выполнен для чата %s, удаляем по одному: %s", chat_id, e)
+        for message_id in message_ids:
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=message_id)
+                logger.debug("Сообщение %s в чате %s удалено по расписанию", message_id, chat_id)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось удалить сообщение об оплате: {e}")
+
+    async def stop(self) -> None:
+        """Останавливает воркер; неудаленные сообщения остаются в чате"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._heap.clear()
+
+
+delete_scheduler = DeleteScheduler()
 
 
 def _extract_payment_id_from_payload(payload: str) -> int | None:
     """Извлекает payment_id из payload. Возвращает None если payload невалидный."""
-    if not payload or not payload.startswith("payment_"):
+    if not payload:
         return None
-    try:
-        return int(payload.split("_")[1])
-    except (ValueError, IndexError):
+    head, sep, tail = payload.partition("_")
+    if not sep or head != "payment":
+        return None
+    # Как и split("_")[1]: берем только часть до следующего "_"
+    payment_id = tail.partition("_")[0]
+    # int() принимает пробелы, знак и "_" между цифрами — пропускаем только ASCII-цифры
+    if not (payment_id.isascii() and payment_id.isdigit()):
         return None
+    return int(payment_id)
 
 
 @dp.pre_checkout_query()
@@ -168,19 +268,22 @@ async def on_successful_payment(msg: Message) -> None:
                     "bot_owner_id": payment_data.bot_owner_id,
                     "bot_id": payment_data.bot_id,
                 }
-                asyncio.create_task(notify_user_payment_success(user_id, amount, bot_id, payment_dict))
+                # notify_user_payment_success — заглушка без I/O, отдельная задача не нужна
+                await notify_user_payment_success(user_id, amount, bot_id, payment_dict)
             except Exception as e:
-                logger.error(f"Ошибка создания задачи отправки уведомления в исходный бот: {e}", exc_info=True)
+                logger.error(f"Ошибка отправки уведомления в исходный бот: {e}", exc_info=True)
 
+    except (asyncpg.PostgresError, TelegramAPIError) as e:
+        logger.error(f"Ошибка обработки successful_payment {payment_id}: {e}", exc_info=logger.isEnabledFor(logging.DEBUG))
     except Exception as e:
         logger.error(f"Ошибка обработки successful_payment: {e}", exc_info=True)
 
 
-async def send_payment_success_message_to_user(user_id: int, amount: int, stars_amount: int, payment_id: int, payment_data) -> None:
+async def send_payment_success_message_to_user(user_id: int, amount: int, stars_amount: int, payment_id: int, payment_data: PaymentRecord) -> None:
     """Отправляет сообщение об успешном пополнении баланса пользователю через тот же бот, что использовался для оплаты"""
     try:
         # Получаем токен и token_id для отправки сообщения
-        token_data = await services.get_payment_token_id_for_success_message(payment_id, payment_data)
+        token_data = await services.get_token_for_payment(payment_data)
         if not token_data:
             logger.warning(f"Не удалось получить токен для отправки сообщения пользователю {user_id}")
             return
@@ -188,21 +291,23 @@ async def send_payment_success_message_to_user(user_id: int, amount: int, stars_
         token, token_id = token_data
         
         lang = await services.get_user_lang(user_id)
-        success_message = tr(lang, "stars_bot_payment_success", amount=amount, stars_amount=stars_amount)
+        success_message = get_template(lang, "stars_bot_payment_success").format(amount=amount, stars_amount=stars_amount)
         payment_menu_keyboard = build_payment_menu_keyboard(lang)
         
-        bot = Bot(token=token)
-        try:
-            await bot.send_message(
-                chat_id=user_id,
-                text=success_message,
-                parse_mode="HTML",
-                reply_markup=payment_menu_keyboard,
-            )
-            logger.info(f"✅ Отправлено сообщение об успешном пополнении пользователю {user_id} через token_id={token_id}")
-        finally:
-            await bot.session.close()
+        bot = transport.get_bot(token)
+        await outbox.enqueue(
+            bot,
+            "send_message",
+            chat_id=user_id,
+            text=success_message,
+            parse_mode="HTML",
+            reply_markup=payment_menu_keyboard,
+        )
+        logger.info(f"✅ Отправлено сообщение об успешном пополнении пользователю {user_id} через token_id={token_id}")
             
+    except TelegramAPIError as e:
+        # Пользователь заблокировал бота, лимиты и т.п. — трассировка нужна только при отладке
+        logger.warning(f"⚠️ Telegram отклонил сообщение об успешном пополнении пользователю {user_id}: {e}", exc_info=logger.isEnabledFor(logging.DEBUG))
     except Exception as e:
         logger.error(f"❌ Ошибка отправки сообщения об успешном пополнении пользователю {user_id}: {e}", exc_info=True)
 
@@ -217,16 +322,22 @@ async def send_payment_menu(msg: Message) -> None:
     keyboard = build_topup_keyboard(lang)
     payment_menu_keyboard = build_payment_menu_keyboard(lang)
     
-    await msg.answer(
-        welcome_text,
+    await outbox.enqueue(
+        msg.bot,
+        "send_message",
+        chat_id=msg.chat.id,
+        text=welcome_text,
         parse_mode="HTML",
         reply_markup=payment_menu_keyboard,
     )
     
-    await msg.answer(
-        welcome_inline_text,
+    await outbox.enqueue(
+        msg.bot,
+        "send_message",
+        chat_id=msg.chat.id,
+        text=welcome_inline_text,
         parse_mode="HTML",
-        reply_markup=keyboard.as_markup(),
+        reply_markup=keyboard,
     )
 
 
@@ -237,7 +348,7 @@ async def cmd_start(msg: Message) -> None:
 
 
 @dp.callback_query(F.data.startswith("topup_"))
-async def handle_topup_callback(callback: CallbackQuery, bot: Bot) -> None:
+async def handle_topup_callback(callback: CallbackQuery, bot: Bot, token_id: int | None = None) -> None:
     """Обработчик callback query для кнопок выбора суммы пополнения"""
     await callback.answer()
     
@@ -252,20 +363,16 @@ async def handle_topup_callback(callback: CallbackQuery, bot: Bot) -> None:
         user_id = callback.from_user.id
         lang = await services.get_user_lang(user_id)
         
-        token_id = None
-        if bot and bot.token:
-            token_id = await db_get_stars_bot_token_id_by_token(bot.token)
-        
         payment_id = await services.create_payment(user_id, credits)
 
-        stars_amount = get_stars_for_credits(credits)
+        stars_amount = CREDITS_TO_STARS.get(credits) or get_stars_amount_for_credits(credits)
 
         invoice_data = await transport.create_invoice_link(payment_id, credits, lang, stars_amount=stars_amount, token_id=token_id)
         
         if not invoice_data:
             error_msg = tr(lang, "stars_bot_payment_error", payment_id=payment_id)
             if callback.message:
-                await callback.message.answer(error_msg, parse_mode="HTML")
+                await outbox.enqueue(bot, "send_message", chat_id=callback.message.chat.id, text=error_msg, parse_mode="HTML")
             return
         
         invoice_link, bot_username = invoice_data
@@ -275,49 +382,51 @@ async def handle_topup_callback(callback: CallbackQuery, bot: Bot) -> None:
         if not callback.message:
             return
         
-        sent_message = await callback.message.answer(
-            message_text,
+        sent_message = await outbox.enqueue(
+            bot,
+            "send_message",
+            chat_id=callback.message.chat.id,
+            text=message_text,
             reply_markup=keyboard.as_markup(),
             parse_mode="HTML",
         )
         
-        async def delete_after_delay():
-            await asyncio.sleep(MESSAGE_DELETE_DELAY)
-            try:
-                if callback.message:
-                    await bot.delete_message(
-                        chat_id=sent_message.chat.id,
-                        message_id=sent_message.message_id
-                    )
-                    logger.debug("Сообщение об оплате удалено через %s секунд (payment_id=%s)", MESSAGE_DELETE_DELAY, payment_id)
-            except Exception as e:
-                logger.warning(f"⚠️ Не удалось удалить сообщение об оплате: {e}")
-        
-        asyncio.create_task(delete_after_delay())
+        delete_scheduler.schedule(
+            asyncio.get_running_loop().time() + MESSAGE_DELETE_DELAY,
+            bot,
+            sent_message.chat.id,
+            sent_message.message_id,
+        )
         
     except ValueError:
         logger.error(f"Невалидный callback_data: {callback.data}")
+    except (asyncpg.PostgresError, TelegramAPIError) as e:
+        # Ожидаемые ошибки БД/Telegram (в т.ч. 429): без форматирования трассировки
+        logger.error(f"Ошибка обработки callback topup: {e}", exc_info=logger.isEnabledFor(logging.DEBUG))
+        await _send_topup_error(callback, bot)
     except Exception as e:
         logger.error(f"Ошибка обработки callback topup: {e}", exc_info=True)
-        if callback.message:
-            lang = await services.get_user_lang(callback.from_user.id)
-            await callback.message.answer(
-                tr(lang, "stars_bot_payment_error_generic"),
-                parse_mode="HTML"
-            )
+        await _send_topup_error(callback, bot)
+
+
+async def _send_topup_error(callback: CallbackQuery, bot: Bot) -> None:
+    """Сообщает пользователю об ошибке обработки выбора суммы пополнения"""
+    if not callback.message:
+        return
+    lang = await services.get_user_lang(callback.from_user.id)
+    await outbox.enqueue(
+        bot,
+        "send_message",
+        chat_id=callback.message.chat.id,
+        text=tr(lang, "stars_bot_payment_error_generic"),
+        parse_mode="HTML",
+    )
 
 
-@dp.message(F.text)
+@dp.message(F.text.in_(_MENU_BUTTON_TEXTS))
 async def handle_payment_menu_text(msg: Message) -> None:
     """Обработчик текстовых сообщений с кнопкой 'Меню оплаты'"""
-    if msg.text and msg.text.startswith("/"):
-        return
-    
-    lang = await services.get_user_lang(msg.from_user.id)
-    payment_menu_text = tr(lang, "btn_payment_menu")
-    
-    if msg.text == payment_menu_text:
-        await send_payment_menu(msg)
+    await send_payment_menu(msg)
 
 
 @dp.callback_query()
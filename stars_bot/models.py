@@ -1,17 +1,10 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 from typing import Any, Mapping, Optional, Sequence
 
 
-def row_to_dict(row: Mapping[str, Any] | Sequence[Any], columns: tuple[str, ...]) -> dict[str, Any]:
-    """Преобразует строку БД в словарь с именованными колонками"""
-    if isinstance(row, Mapping):
-        return dict(row)
-    return {col: row[idx] if idx < len(row) else None for idx, col in enumerate(columns)}
-
-
 PAYMENT_COLUMNS = (
     "id",
     "user_id",
@@ -23,7 +16,7 @@ PAYMENT_COLUMNS = (
     "created_at",
 )
 
-@dataclass
+@dataclass(slots=True)
 class PaymentRecord:
     id: int
     user_id: int
@@ -36,17 +29,19 @@ class PaymentRecord:
 
     @classmethod
     def from_row(cls, row: Mapping[str, Any] | Sequence[Any]) -> "PaymentRecord":
-        data = row_to_dict(row, PAYMENT_COLUMNS)
-        return cls(
-            id=data["id"],
-            user_id=data["user_id"],
-            amount=data["amount"],
-            status=data["status"],
-            payment_provider=data["payment_provider"],
-            bot_owner_id=data.get("bot_owner_id"),
-            bot_id=data.get("bot_id"),
-            created_at=data.get("created_at"),
-        )
+        if isinstance(row, Mapping):
+            return cls(
+                id=row["id"],
+                user_id=row["user_id"],
+                amount=row["amount"],
+                status=row["status"],
+                payment_provider=row["payment_provider"],
+                bot_owner_id=row.get("bot_owner_id"),
+                bot_id=row.get("bot_id"),
+                created_at=row.get("created_at"),
+            )
+        # Колонки идут в порядке PAYMENT_COLUMNS — передаем позиционно, без промежуточного dict
+        return cls(*row[:len(PAYMENT_COLUMNS)])
 
 
 STARS_BOT_TOKEN_COLUMNS = (
@@ -59,7 +54,7 @@ STARS_BOT_TOKEN_COLUMNS = (
 )
 
 
-@dataclass
+@dataclass(slots=True)
 class StarsBotToken:
     id: int
     token: str
@@ -67,19 +62,27 @@ class StarsBotToken:
     is_active: bool = True
     created_at: Optional[datetime] = None
     updated_at: Optional[datetime] = None
+    token_preview: str = field(init=False, repr=False)  # начало токена для логов
+
+    def __post_init__(self) -> None:
+        # is_active приводим к bool и для позиционных строк (драйвер может вернуть 0/1)
+        self.is_active = bool(self.is_active)
+        self.token_preview = self.token[:8] if self.token else "unknown"
 
     @classmethod
     def from_row(cls, row: Mapping[str, Any] | Sequence[Any]) -> "StarsBotToken":
         """Создает StarsBotToken из строки БД"""
-        data = row_to_dict(row, STARS_BOT_TOKEN_COLUMNS)
-        return cls(
-            id=data["id"],
-            token=data["token"],
-            bot_username=data.get("bot_username"),
-            is_active=bool(data.get("is_active", True)),
-            created_at=data.get("created_at"),
-            updated_at=data.get("updated_at"),
-        )
+        if isinstance(row, Mapping):
+            return cls(
+                id=row["id"],
+                token=row["token"],
+                bot_username=row.get("bot_username"),
+                is_active=row.get("is_active", True),
+                created_at=row.get("created_at"),
+                updated_at=row.get("updated_at"),
+            )
+        # Колонки идут в порядке STARS_BOT_TOKEN_COLUMNS — передаем позиционно, без промежуточного dict
+        return cls(*row[:len(STARS_BOT_TOKEN_COLUMNS)])
 
 
 # Константы
@@ -0,0 +1,134 @@
+"""
+Очередь исходящих сообщений в Telegram с ограничением частоты отправки.
+Лимиты Telegram действуют на каждый токен отдельно: не более 30 сообщений в секунду от бота
+и около 1 сообщения в секунду в один чат (короткие всплески допускаются)
+"""
+import asyncio
+import logging
+from typing import Any
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+BOT_RATE_LIMIT = 30  # сообщений в секунду от одного бота
+PER_CHAT_INTERVAL = 1.0  # секунд между сообщениями в один чат в установившемся режиме
+PER_CHAT_BURST = 3  # сколько сообщений подряд можно отправить в чат без ожидания
+_SCHEDULE_PRUNE_SIZE = 10_000
+
+
+def _reserve(schedule: dict, key: Any, now: float, interval: float, burst: int) -> float:
+    """
+    Резервирует слот отправки по ключу (алгоритм GCRA) и возвращает время отправки.
+    schedule хранит теоретическое время следующего слота: до burst сообщений уходят сразу,
+    дальше — не чаще одного за interval
+    """
+    tat = max(schedule.get(key, now), now)
+    send_at = max(now, tat - (burst - 1) * interval)
+    schedule[key] = tat + interval
+    return send_at
+
+
+class TelegramOutbox:
+    """Отправка вызовов Bot API с соблюдением лимитов Telegram для каждого бота и каждого чата"""
+
+    def __init__(
+        self,
+        rate_limit: int = BOT_RATE_LIMIT,
+        per_chat_interval: float = PER_CHAT_INTERVAL,
+        per_chat_burst: int = PER_CHAT_BURST,
+    ) -> None:
+        self._send_interval = 1.0 / rate_limit
+        self._per_chat_interval = per_chat_interval
+        self._per_chat_burst = per_chat_burst
+        # bot.id -> время следующего свободного слота бота
+        self._bot_schedule: dict[int, float] = {}
+        # (bot.id, chat_id) -> теоретическое время следующего сообщения в чат
+        self._chat_schedule: dict[tuple[int, int | str], float] = {}
+        # Отложенные вызовы: future вызывающего -> таймер запуска отправки
+        self._delayed: dict[asyncio.Future, asyncio.TimerHandle] = {}
+        self._send_tasks: set[asyncio.Task] = set()
+
+    def _prune(self, now: float) -> None:
+        """Убирает записи о слотах, которые уже в прошлом"""
+        if len(self._chat_schedule) > _SCHEDULE_PRUNE_SIZE:
+            self._chat_schedule = {key: ts for key, ts in self._chat_schedule.items() if ts > now}
+        if len(self._bot_schedule) > _SCHEDULE_PRUNE_SIZE:
+            self._bot_schedule = {key: ts for key, ts in self._bot_schedule.items() if ts > now}
+
+    async def enqueue(self, bot: Bot, method: str, **kwargs: Any) -> Any:
+        """Ставит вызов bot.<method>(**kwargs) в очередь и возвращает его результат"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        now = loop.time()
+
+        # Слот в чате резервируется сразу: сообщения в один чат уходят в порядке постановки
+        chat_id = kwargs.get("chat_id")
+        if chat_id is None:
+            self._dispatch(bot, method, kwargs, future)
+        else:
+            send_at = _reserve(
+                self._chat_schedule, (bot.id, chat_id), now, self._per_chat_interval, self._per_chat_burst
+            )
+            self._prune(now)
+            if send_at > now:
+                self._delayed[future] = loop.call_later(send_at - now, self._dispatch, bot, method, kwargs, future)
+            else:
+                self._dispatch(bot, method, kwargs, future)
+
+        return await future
+
+    def _dispatch(self, bot: Bot, method: str, kwargs: dict[str, Any], future: asyncio.Future) -> None:
+        """Занимает слот бота в момент, когда вызов готов к отправке по лимиту чата"""
+        self._delayed.pop(future, None)
+        if future.done():
+            # Вызывающий уже отменил ожидание
+            return
+        # Слот бота берется только сейчас, а не при постановке: очередь одного чата не задерживает остальные чаты
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        send_at = _reserve(self._bot_schedule, bot.id, now, self._send_interval, 1)
+        if send_at > now:
+            self._delayed[future] = loop.call_later(send_at - now, self._start_send, bot, method, kwargs, future)
+        else:
+            self._start_send(bot, method, kwargs, future)
+
+    def _start_send(self, bot: Bot, method: str, kwargs: dict[str, Any], future: asyncio.Future) -> None:
+        self._delayed.pop(future, None)
+        if future.done():
+            return
+        task = asyncio.create_task(self._send(bot, method, kwargs, future))
+        self._send_tasks.add(task)
+        task.add_done_callback(self._send_tasks.discard)
+
+    async def _send(self, bot: Bot, method: str, kwargs: dict[str, Any], future: asyncio.Future) -> None:
+        try:
+            try:
+                result = await getattr(bot, method)(**kwargs)
+            except TelegramRetryAfter as e:
+                # Telegram сообщает, сколько ждать; повторяем один раз
+                logger.warning(f"⚠️ Лимит Telegram при вызове {method}, повтор через {e.retry_after} с")
+                await asyncio.sleep(e.retry_after)
+                result = await getattr(bot, method)(**kwargs)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
+
+    async def stop(self) -> None:
+        """Отменяет еще не отправленные вызовы и дожидается уже начатых отправок"""
+        # Отложенные вызовы так и не будут отправлены — отменяем, чтобы не зависли ожидающие
+        for future, handle in list(self._delayed.items()):
+            handle.cancel()
+            future.cancel()
+        self._delayed.clear()
+        if self._send_tasks:
+            await asyncio.gather(*self._send_tasks, return_exceptions=True)
+        self._chat_schedule.clear()
+        self._bot_schedule.clear()
+
+
+outbox = TelegramOutbox()
@@ -2,22 +2,28 @@
 Сервисный слой для работы с платежами через Telegram Stars
 Вся бизнес-логика и работа с БД
 """
+import asyncio
 import logging
+import random
+import sys
+import time
+from collections import OrderedDict
 from typing import List, Optional
 
+import asyncpg
+
 from stars_bot.database.operations import (
     db_add_credits,
     db_add_referral_bonus,
     db_create_payment,
+    db_finalize_payment,
     db_get_lang,
     db_get_payment_row_by_id,
     db_get_payment_row_by_external_id,
     db_get_stars_bot_token_by_id,
     db_list_active_stars_bot_tokens_rows,
-    db_pick_random_active_stars_bot_token,
     db_update_payment_status_by_id,
     db_update_payment_stars_bot_token_id,
-    db_update_payment_usd_breakdown,
     db_update_referral_status,
 )
 
@@ -26,6 +32,24 @@ from .utils import get_stars_amount_for_credits
 
 logger = logging.getLogger(__name__)
 
+# LRU кэш языков пользователей: user_id -> (lang, время записи)
+# users.lang этот сервис не пишет, поэтому TTL — единственная инвалидация кэша
+LANG_CACHE_TTL = 300  # секунд
+LANG_CACHE_MAX_SIZE = 50_000
+_lang_cache: OrderedDict[int, tuple[Optional[str], float]] = OrderedDict()
+# Текущие запросы языка в БД: параллельные промахи по одному user_id ждут один запрос
+_lang_inflight: dict[int, asyncio.Task] = {}
+
+# Кэш токенов по token_id: token_id -> ((token, bot_username), время записи)
+TOKEN_CACHE_TTL = 300  # секунд
+_token_by_id_cache: dict[int, tuple[tuple[str, Optional[str]], float]] = {}
+
+# Снимок активных токенов для случайного выбора (обновляется не чаще раза в TOKENS_SNAPSHOT_TTL)
+TOKENS_SNAPSHOT_TTL = 60  # секунд
+_tokens_snapshot: List[StarsBotToken] = []
+_tokens_loaded_at: float | None = None
+_tokens_lock = asyncio.Lock()
+
 
 async def _get_bot_owner_id_from_payment(payment_id: int) -> Optional[int]:
     """Получает bot_owner_id из платежа"""
@@ -50,23 +74,52 @@ async def create_payment(user_id: int, amount: int, bot_owner_id: Optional[int]
     return payment_id
 
 
+async def _load_user_lang(user_id: int) -> Optional[str]:
+    """Загружает язык пользователя из БД и кладет его в кэш"""
+    lang = await db_get_lang(user_id)
+    if lang:
+        # Строка из БД не интернирована: интернируем один раз, чтобы поиск в таблицах переводов шел по идентичности
+        lang = sys.intern(lang)
+    _lang_cache[user_id] = (lang, time.monotonic())
+    _lang_cache.move_to_end(user_id)
+    if len(_lang_cache) > LANG_CACHE_MAX_SIZE:
+        _lang_cache.popitem(last=False)
+    return lang
+
+
 async def get_user_lang(user_id: int) -> str:
     """Получает язык пользователя, возвращает 'ru' по умолчанию"""
-    lang = await db_get_lang(user_id)
+    cached = _lang_cache.get(user_id)
+    if cached is not None and time.monotonic() - cached[1] < LANG_CACHE_TTL:
+        _lang_cache.move_to_end(user_id)
+        return cached[0] or "ru"
+
+    task = _lang_inflight.get(user_id)
+    if task is None:
+        task = asyncio.create_task(_load_user_lang(user_id))
+        _lang_inflight[user_id] = task
+        task.add_done_callback(lambda _: _lang_inflight.pop(user_id, None))
+    # shield: отмена одного из ожидающих не отменяет общий запрос
+    lang = await asyncio.shield(task)
     return lang or "ru"
 
 
-async def get_payment_token_id_for_success_message(payment_id: int, payment_data: PaymentRecord | None = None) -> Optional[tuple[str, int]]:
-    """Получает токен и token_id для отправки сообщения об успешном пополнении. Возвращает (token, token_id) или None"""
+async def get_stars_bot_token_by_id(token_id: int) -> Optional[tuple[str, Optional[str]]]:
+    """Получает токен и username по token_id (с кэшированием на TOKEN_CACHE_TTL секунд)"""
+    cached = _token_by_id_cache.get(token_id)
+    if cached is not None and time.monotonic() - cached[1] < TOKEN_CACHE_TTL:
+        return cached[0]
+    token_data = await db_get_stars_bot_token_by_id(token_id)
+    if token_data:
+        _token_by_id_cache[token_id] = (token_data, time.monotonic())
+    return token_data
+
+
+async def get_token_for_payment(payment_data: PaymentRecord) -> Optional[tuple[str, int]]:
+    """Получает токен и token_id бота, через который был создан платеж. Возвращает (token, token_id) или None"""
     try:
-        if payment_data:
-            bot_id_str = payment_data.bot_id
-        else:
-            payment_data = await get_payment_by_id(payment_id)
-            if not payment_data:
-                logger.error(f"Платеж {payment_id} не найден")
-                return None
-            bot_id_str = payment_data.bot_id
+        payment_id = payment_data.id
+        bot_id_str = payment_data.bot_id
         
         token_id = None
         if bot_id_str and str(bot_id_str).startswith("stars_token_"):
@@ -76,7 +129,7 @@ async def get_payment_token_id_for_success_message(payment_id: int, payment_data
                 logger.warning(f"Не удалось извлечь token_id из bot_id={bot_id_str}")
         
         if token_id:
-            token_data = await db_get_stars_bot_token_by_id(token_id)
+            token_data = await get_stars_bot_token_by_id(token_id)
             if not token_data:
                 logger.warning(f"Не удалось получить токен для token_id={token_id}, используем случайный")
                 token_data = await get_random_active_stars_bot_token()
@@ -104,23 +157,16 @@ async def get_payment_token_id_for_success_message(payment_id: int, payment_data
 
 
 async def process_payment_success(
-    payment_id: int, user_id: int, amount: int, stars_amount: int, payment_data: PaymentRecord | None = None
+    payment_id: int, user_id: int, amount: int, stars_amount: int, payment_data: PaymentRecord
 ) -> tuple[bool, PaymentRecord | None]:
     """
     Обрабатывает успешный платеж:
     - Проверяет статус платежа (если уже completed - ничего не делает)
-    - Начисляет кредиты пользователю
-    - Начисляет реферальный бонус (если есть)
-    - Обновляет статус платежа в БД на completed
-    - Обновляет статус реферала
-    - Обновляет USD значения для статистики
+    - Одним запросом обновляет статус на completed с USD значениями и начисляет кредиты пользователю
+    - Начисляет реферальный бонус (если есть) и обновляет статус реферала
+
+    payment_data — запись платежа, уже загруженная вызывающим кодом (повторно не читается)
     """
-    if not payment_data:
-        payment_data = await get_payment_by_id(payment_id)
-        if not payment_data:
-            logger.error(f"Платеж {payment_id} не найден в БД")
-            return False, None
-    
     # Проверяем статус платежа ПЕРЕД обработкой
     if payment_data.status == "completed":
         logger.info(f"Платеж {payment_id} уже обработан (статус: completed), пропускаем обработку")
@@ -131,74 +177,90 @@ async def process_payment_success(
     if bot_owner_id:
         logger.debug("Получен bot_owner_id из платежа: %s", bot_owner_id)
 
-    # Начисляем кредиты пользователю
-    try:
-        await db_add_credits(user_id, amount)
-        logger.info(f"✅ Начислено {amount} кредитов пользователю {user_id} за платеж {payment_id}")
-    except Exception as e:
-        logger.error(f"❌ Ошибка начисления кредитов: {e}")
-        return False
-
-    # Обновляем статус платежа напрямую по payment_id
-    status_updated = await db_update_payment_status_by_id(payment_id, "completed")
-
-    if not status_updated:
-        logger.warning(f"⚠️ Не удалось обновить статус платежа {payment_id}, но кредиты уже начислены")
-        # Не возвращаем False, так как кредиты уже начислены
-    else:
-        logger.debug("Статус платежа %s обновлен на 'completed' в БД", payment_id)
-
-    if bot_owner_id:
-        try:
-            await db_add_referral_bonus(user_id, amount, bot_owner_id=bot_owner_id)
-            logger.debug(
-                "Начислен реферальный бонус владельцу бота %s за платеж пользователя %s",
-                bot_owner_id,
-                user_id,
-            )
-        except Exception as e:
-            logger.warning(f"⚠️ Ошибка начисления реферального бонуса: {e}")
-
-    # Обновляем статус реферала
-    try:
-        await db_update_referral_status(referred_id=user_id, status="completed")
-        logger.debug("Статус реферала обновлен для пользователя %s", user_id)
-    except Exception as e:
-        logger.warning(f"⚠️ Ошибка обновления статуса реферала: {e}")
-
-    # Обновляем реальные USD значения в БД для статистики
+    # Реальные USD значения для статистики
     gross_amount_usd = stars_amount * STARS_TO_USD_RATE
     # Для Telegram Stars комиссия Telegram = 0%, поэтому net = gross, fee = 0
     net_amount_usd = gross_amount_usd
     fee_amount_usd = 0.0
 
+    # Статус и кредиты — одним запросом (атомарно)
     try:
-        await db_update_payment_usd_breakdown(
+        finalized = await db_finalize_payment(
             payment_id,
+            user_id,
+            amount,
             net_amount_usd=net_amount_usd,
             gross_amount_usd=gross_amount_usd,
             fee_amount_usd=fee_amount_usd,
         )
-        logger.debug(
-            "Обновлены реальные USD значения: %s звезд = $%.2f USD",
-            stars_amount,
-            gross_amount_usd,
-        )
+    except asyncpg.PostgresError as e:
+        # Ошибка БД ожидаема (таймауты, блокировки): трассировка нужна только при отладке
+        logger.error(f"❌ Ошибка БД при проведении платежа {payment_id}: {e}", exc_info=logger.isEnabledFor(logging.DEBUG))
+        return False, None
     except Exception as e:
-        logger.warning(f"⚠️ Ошибка обновления USD значений: {e}")
+        logger.error(f"❌ Ошибка проведения платежа {payment_id}: {e}", exc_info=True)
+        return False, None
+
+    if not finalized:
+        logger.info(f"Платеж {payment_id} уже обработан (статус: completed), пропускаем обработку")
+        return True, None
+
+    logger.info(f"✅ Начислено {amount} кредитов пользователю {user_id} за платеж {payment_id}")
+    logger.debug(
+        "Обновлены реальные USD значения: %s звезд = $%.2f USD",
+        stars_amount,
+        gross_amount_usd,
+    )
+
+    # Реферальные шаги не откатывают оплату и не зависят друг от друга — выполняем параллельно после фиксации
+    bonus_added, referral_updated = await asyncio.gather(
+        db_add_referral_bonus(user_id, amount, bot_owner_id=bot_owner_id),
+        db_update_referral_status(referred_id=user_id, status="completed"),
+        return_exceptions=True,
+    )
+
+    if isinstance(bonus_added, BaseException):
+        logger.warning(f"⚠️ Ошибка начисления реферального бонуса: {bonus_added}")
+    elif bonus_added:
+        logger.info(f"✅ Начислен реферальный бонус владельцу бота {bot_owner_id} за платеж {payment_id}")
+
+    if isinstance(referral_updated, BaseException):
+        logger.warning(f"⚠️ Ошибка обновления статуса реферала: {referral_updated}")
 
     return True, payment_data
 
 
 async def get_active_stars_bot_tokens() -> List[StarsBotToken]:
-    """Получает все активные токены Stars Payment Bot"""
+    """Получает все активные токены Stars Payment Bot из БД и обновляет их снимок в памяти"""
+    global _tokens_snapshot, _tokens_loaded_at
     rows = await db_list_active_stars_bot_tokens_rows()
-    return [StarsBotToken.from_row(row) for row in rows]
+    tokens = [StarsBotToken.from_row(row) for row in rows]
+    _tokens_snapshot = tokens
+    _tokens_loaded_at = time.monotonic()
+    return tokens
+
+
+def invalidate_active_stars_bot_tokens() -> None:
+    """Сбрасывает снимок активных токенов (вызывать при изменении набора ботов)"""
+    global _tokens_loaded_at
+    _tokens_loaded_at = None
+
+
+def _tokens_snapshot_fresh() -> bool:
+    return _tokens_loaded_at is not None and time.monotonic() - _tokens_loaded_at < TOKENS_SNAPSHOT_TTL
 
 
 async def get_random_active_stars_bot_token() -> Optional[tuple[str, int, Optional[str]]]:
     """Получает случайный активный токен, token_id и username Stars Payment Bot для создания invoice"""
-    return await db_pick_random_active_stars_bot_token()
+    if not _tokens_snapshot_fresh():
+        async with _tokens_lock:
+            # Снимок мог обновить другой запрос, пока мы ждали блокировку
+            if not _tokens_snapshot_fresh():
+                await get_active_stars_bot_tokens()
+    if not _tokens_snapshot:
+        return None
+    token_record = random.choice(_tokens_snapshot)
+    return token_record.token, token_record.id, token_record.bot_username
 
 
 async def get_payment_by_external_id(external_payment_id: str, payment_provider: str = "stars") -> Optional[PaymentRecord]:
@@ -242,23 +304,25 @@ async def process_payment_manually(external_payment_id: str, payment_provider: s
             logger.error(f"❌ Ошибка начисления кредитов: {e}")
             return False, None
         
-        # Начисляем реферальный бонус (если есть)
-        if bot_owner_id:
-            try:
-                await db_add_referral_bonus(user_id, amount, bot_owner_id=bot_owner_id)
-                logger.info(f"✅ Начислен реферальный бонус владельцу бота {bot_owner_id} за платеж {payment_id}")
-            except Exception as e:
-                logger.warning(f"⚠️ Ошибка начисления реферального бонуса: {e}")
+        # Статус платежа, реферальный бонус и статус реферала не зависят друг от друга — выполняем параллельно
+        status_updated, bonus_added, referral_updated = await asyncio.gather(
+            db_update_payment_status_by_id(payment_id, "completed"),
+            db_add_referral_bonus(user_id, amount, bot_owner_id=bot_owner_id),
+            db_update_referral_status(referred_id=user_id, status="completed"),
+            return_exceptions=True,
+        )
         
-        # Обновляем статус реферала
-        try:
-            await db_update_referral_status(referred_id=user_id, status="completed")
+        if isinstance(bonus_added, BaseException):
+            logger.warning(f"⚠️ Ошибка начисления реферального бонуса: {bonus_added}")
+        elif bonus_added:
+            logger.info(f"✅ Начислен реферальный бонус владельцу бота {bot_owner_id} за платеж {payment_id}")
+        
+        if isinstance(referral_updated, BaseException):
+            logger.warning(f"⚠️ Ошибка обновления статуса реферала: {referral_updated}")
+        else:
             logger.debug(f"Статус реферала обновлен для пользователя {user_id}")
-        except Exception as e:
-            logger.warning(f"⚠️ Ошибка обновления статуса реферала: {e}")
         
-        status_updated = await db_update_payment_status_by_id(payment_id, "completed")
-        if status_updated:
+        if status_updated is True:
             logger.info(f"✅ Статус платежа {payment_id} обновлен на 'completed'")
         else:
             logger.warning(f"⚠️ Не удалось обновить статус платежа {payment_id}")
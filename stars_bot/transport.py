@@ -1,27 +1,128 @@
 """
-Транспортный слой для создания invoice
+Транспортный слой: общая HTTP сессия Telegram и создание invoice
 """
+import asyncio
 import logging
+from functools import lru_cache
 from typing import Optional
 
 from aiogram import Bot
 from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.types import LabeledPrice
 
-from stars_bot.config.settings import Settings
-from stars_bot.database.operations import (
-    db_get_stars_bot_token_by_id,
-    db_update_payment_stars_bot_token_id,
-)
-from stars_bot.ui.translations import tr
+from stars_bot.config.settings import get_settings
+from stars_bot.database.operations import db_update_payment_stars_bot_token_id
+from stars_bot.ui.translations import tr_many
 from stars_bot.utils import get_stars_amount_for_credits
 
 from . import services
 
 logger = logging.getLogger(__name__)
 
+
+class TelegramSession(AiohttpSession):
+    """AiohttpSession с настраиваемыми лимитами пула соединений и keep-alive"""
+
+    def __init__(
+        self,
+        proxy: str | None = None,
+        limit: int = 100,
+        limit_per_host: int = 0,
+        keepalive_timeout: float = 15,
+        ttl_dns_cache: int | None = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(proxy=proxy, limit=limit, **kwargs)
+        # Параметры передаются в TCPConnector (или ProxyConnector) при создании ClientSession.
+        # limit повторяем: с прокси aiogram пересобирает _connector_init и теряет его
+        self._connector_init.update(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            keepalive_timeout=keepalive_timeout,
+        )
+        # Без явного значения остается TTL DNS кэша aiogram
+        if ttl_dns_cache is not None:
+            self._connector_init["ttl_dns_cache"] = ttl_dns_cache
+
+
+@lru_cache(maxsize=256)
+def _invoice_strings(lang: str, amount: int) -> tuple[str, str, str]:
+    """Заголовок, описание и подпись цены invoice (пресетов сумм немного — кэш почти всегда попадает)"""
+    title, description, label = tr_many(
+        lang,
+        ("payment_invoice_title", "payment_invoice_description", "payment_invoice_label"),
+        amount=amount,
+    )
+    return title, description, label
+
+
+# Маркер "прокси еще не определен" (None означает "прокси не настроен")
+_UNSET = object()
+
 # Кэш для прокси URL
-_cached_proxy_url: str | None = None
+_cached_proxy_url: str | None | object = _UNSET
+
+
+def _get_proxy_url() -> str | None:
+    """Возвращает прокси URL из настроек (определяется один раз за процесс)"""
+    global _cached_proxy_url
+    # Между проверкой и присваиванием нет await, поэтому конкурентные корутины не загрузят настройки повторно
+    if _cached_proxy_url is _UNSET:
+        _cached_proxy_url = get_settings().get_proxy_url() or None
+    return _cached_proxy_url
+
+
+# Общая HTTP сессия к Telegram Bot API для всех ботов процесса (webhook боты, пул исходящих, invoice):
+# один пул keep-alive соединений, TLS и DNS кэш к api.telegram.org
+_telegram_session: TelegramSession | None = None
+
+
+def get_telegram_session() -> TelegramSession:
+    """Возвращает общую сессию Telegram (создает при первом вызове с лимитами из Settings)"""
+    global _telegram_session
+    if _telegram_session is None:
+        settings = get_settings()
+        _telegram_session = TelegramSession(
+            proxy=_get_proxy_url(),
+            limit=settings.telegram_conn_limit,
+            limit_per_host=settings.telegram_conn_limit_per_host,
+            keepalive_timeout=settings.telegram_keepalive_timeout,
+            ttl_dns_cache=settings.telegram_dns_cache_ttl,
+        )
+    return _telegram_session
+
+
+# Bot по токену поверх общей сессии (единый пул для исходящих сообщений и invoice)
+_bot_pool: dict[str, Bot] = {}
+
+
+def get_bot(token: str) -> Bot:
+    """Возвращает Bot для токена из пула (создает при первом обращении)"""
+    bot = _bot_pool.get(token)
+    if bot is None:
+        bot = Bot(token=token, session=get_telegram_session())
+        _bot_pool[token] = bot
+    return bot
+
+
+def invalidate_bot(token: str | None = None) -> None:
+    """Сбрасывает Bot для токена из пула (или весь пул, если токен не передан)"""
+    if token is None:
+        _bot_pool.clear()
+    else:
+        _bot_pool.pop(token, None)
+
+
+async def close_telegram_session() -> None:
+    """Закрывает общую сессию Telegram (вызывается один раз при остановке приложения)"""
+    global _telegram_session
+    _bot_pool.clear()
+    if _telegram_session is not None:
+        try:
+            await _telegram_session.close()
+        except Exception as e:
+            logger.warning("⚠️ Ошибка закрытия сессии Telegram: %s", e)
+        _telegram_session = None
 
 
 async def create_invoice_link(
@@ -30,9 +131,9 @@ async def create_invoice_link(
     """Создает invoice link для платежа"""
     try:
         if token_id:
-            token_data = await db_get_stars_bot_token_by_id(token_id)
+            token_data = await services.get_stars_bot_token_by_id(token_id)
             if not token_data:
-                logger.warning(f"Токен с token_id={token_id} не найден, используем случайный")
+                logger.warning("Токен с token_id=%s не найден, используем случайный", token_id)
                 token_data = await services.get_random_active_stars_bot_token()
                 if not token_data:
                     logger.error("❌ Не найдено активных токенов для создания invoice")
@@ -40,46 +141,43 @@ async def create_invoice_link(
                 random_token, token_id, bot_username = token_data
             else:
                 random_token, bot_username = token_data
-                logger.debug("Используем токен для invoice: token=%s..., token_id=%s, username=%s", random_token[:8], token_id, bot_username)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Используем токен для invoice: token=%s..., token_id=%s, username=%s", random_token[:8], token_id, bot_username)
         else:
             token_data = await services.get_random_active_stars_bot_token()
             if not token_data:
                 logger.error("❌ Не найдено активных токенов для создания invoice")
                 return None
             random_token, token_id, bot_username = token_data
-            logger.debug("Получен случайный токен для invoice: token=%s..., token_id=%s, username=%s", random_token[:8], token_id, bot_username)
-        
-        await db_update_payment_stars_bot_token_id(payment_id, token_id)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Получен случайный токен для invoice: token=%s..., token_id=%s, username=%s", random_token[:8], token_id, bot_username)
 
         # Конвертируем кредиты в звезды Telegram по точному курсу, если не передано
         if stars_amount is None:
             stars_amount = get_stars_amount_for_credits(amount)
 
-        # Получаем прокси из настроек
-        global _cached_proxy_url
-        if _cached_proxy_url is None:
-            settings = Settings.load()
-            _cached_proxy_url = settings.get_proxy_url()
-        proxy_url = _cached_proxy_url
-        
-        session = AiohttpSession(proxy=proxy_url, limit=10) if proxy_url else AiohttpSession(limit=10)
-        temp_bot = Bot(token=random_token, session=session)
+        # Bot только привязывает токен к общей сессии, закрывать его не нужно
+        invoice_bot = get_bot(random_token)
+        title, description, label = _invoice_strings(lang, amount)
+        # Сохраняем token_id в платеж параллельно с запросом к Telegram: запись в БД не на критическом пути
+        update_task = asyncio.create_task(db_update_payment_stars_bot_token_id(payment_id, token_id))
         try:
-            invoice_link = await temp_bot.create_invoice_link(
-                title=tr(lang, "payment_invoice_title", amount=amount),
-                description=tr(lang, "payment_invoice_description", amount=amount),
+            invoice_link = await invoice_bot.create_invoice_link(
+                title=title,
+                description=description,
                 payload=f"payment_{payment_id}",
                 currency="XTR",  # XTR - код валюты для Telegram Stars
-                prices=[LabeledPrice(label=tr(lang, "payment_invoice_label", amount=amount), amount=stars_amount)],
+                prices=[LabeledPrice(label=label, amount=stars_amount)],
             )
+        finally:
+            # Дожидаемся записи в любом случае; ошибка БД пробрасывается, как и раньше
+            await update_task
 
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug("Invoice link создан для платежа %s через бот %s...", payment_id, random_token[:8])
-            return (invoice_link, bot_username)
-        finally:
-            # Закрываем сессию временного бота
-            await temp_bot.session.close()
+        return (invoice_link, bot_username)
     except Exception as e:
-        logger.error(f"❌ Ошибка создания invoice link для платежа {payment_id}: {e}", exc_info=True)
+        logger.error("❌ Ошибка создания invoice link для платежа %s: %s", payment_id, e, exc_info=True)
         return None
 
 
@@ -1,7 +1,8 @@
 """Translations for Stars Payment Bot"""
-from typing import Dict
+from types import MappingProxyType
+from typing import Callable, Dict, Mapping
 
-_TRANSLATIONS: Dict[str, Dict[str, str]] = {
+_TRANSLATIONS: Mapping[str, Mapping[str, str]] = {
     "ru": {
         "btn_pay": "💳 Оплатить звездами",
         "btn_payment_menu": "💎 Меню оплаты",
@@ -54,23 +55,68 @@ _TRANSLATIONS: Dict[str, Dict[str, str]] = {
         "stars_bot_payment_success": "🎉 <b>支付成功！</b>\n\n✅ 您获得：<b>{amount} 积分</b>\n⭐ 已支付：<b>{stars_amount} 星币</b>\n\n💚 感谢使用我们的服务！",
     },
 }
+# Переводы неизменяемы: случайная запись в них сразу падает с TypeError
+_TRANSLATIONS = MappingProxyType(
+    {lang: MappingProxyType(messages) for lang, messages in _TRANSLATIONS.items()}
+)
+
+SUPPORTED_LANGS = tuple(_TRANSLATIONS)
+
+# Плоская таблица (lang, key) -> шаблон: один поиск вместо цепочки .get
+_FLAT: Dict[tuple[str, str], str] = {
+    (lang, key): value
+    for lang, messages in _TRANSLATIONS.items()
+    for key, value in messages.items()
+}
+# Русский — язык по умолчанию для неподдерживаемых языков и отсутствующих ключей
+_RU: Dict[str, str] = dict(_TRANSLATIONS["ru"])
+# lang -> полный словарь переводов (отсутствующие ключи уже дополнены русскими)
+_FLAT_LANG: Dict[str, Dict[str, str]] = {
+    lang: {**_RU, **messages} for lang, messages in _TRANSLATIONS.items()
+}
+# Шаблон -> заранее связанный format_map; шаблоны без подстановок сюда не попадают и не форматируются
+_FORMAT_MAP: Dict[str, Callable[[Mapping[str, object]], str]] = {
+    template: template.format_map for template in _FLAT.values() if "{" in template
+}
+
+
+def get_template(lang: str, key: str) -> str:
+    """Возвращает неотформатированный шаблон перевода (с фолбэком на русский)"""
+    return _FLAT.get((lang, key)) or _RU.get(key, key)
 
 
 def tr(lang: str, key: str, **kwargs) -> str:
-    # Если язык не поддерживается, используем русский по умолчанию
-    if lang not in _TRANSLATIONS:
-        lang = "ru"
-    
     # Получаем перевод
-    translation = _TRANSLATIONS.get(lang, {}).get(key, _TRANSLATIONS.get("ru", {}).get(key, key))
+    translation = _FLAT.get((lang, key)) or _RU.get(key, key)
     
-    # Форматируем строку с параметрами, если они есть
+    # Форматируем строку с параметрами, если они есть и в шаблоне есть подстановки
     if kwargs:
-        try:
-            return translation.format(**kwargs)
-        except KeyError:
-            # Если не хватает параметров, возвращаем как есть
-            return translation
+        format_map = _FORMAT_MAP.get(translation)
+        if format_map is not None:
+            try:
+                return format_map(kwargs)
+            except KeyError:
+                # Если не хватает параметров, возвращаем как есть
+                return translation
     
     return translation
 
+
+def tr_many(lang: str, keys: tuple[str, ...], **kwargs) -> list[str]:
+    """Переводит несколько ключей с одними параметрами за одно определение языка"""
+    messages = _FLAT_LANG.get(lang) or _RU
+    if not kwargs:
+        return [messages.get(key, key) for key in keys]
+    result = []
+    for key in keys:
+        translation = messages.get(key, key)
+        format_map = _FORMAT_MAP.get(translation)
+        if format_map is None:
+            result.append(translation)
+            continue
+        try:
+            result.append(format_map(kwargs))
+        except KeyError:
+            # Если не хватает параметров, возвращаем как есть
+            result.append(translation)
+    return result
@@ -1,56 +1,41 @@
 """Utility functions for Stars Payment Bot"""
-import math
+from bisect import bisect_right
+from functools import lru_cache
 
+# Пресеты: кредиты -> звезды (строится один раз при импорте)
+_STARS_MAP = {
+    150: 400,
+    250: 650,
+    500: 1300,
+    1000: 2600,
+    1500: 3850,
+    2000: 5150,
+}
+_SORTED_PRESETS = tuple(sorted(_STARS_MAP))
+# Отрезки интерполяции между соседними пресетами: (lo, hi, lo_stars, hi_stars)
+_SEGMENTS = tuple(
+    (lo, hi, _STARS_MAP[lo], _STARS_MAP[hi])
+    for lo, hi in zip(_SORTED_PRESETS, _SORTED_PRESETS[1:])
+)
 
+
+@lru_cache(maxsize=512)
 def get_stars_amount_for_credits(credits: int) -> int:
     """
     Рассчитывает количество звезд Telegram для указанного количества кредитов
     """
-    stars_map = {
-        150: 400,
-        250: 650,
-        500: 1300,
-        1000: 2600,
-        1500: 3850,
-        2000: 5150
-    }
-    
-    if credits in stars_map:
-        return stars_map[credits]
-    
-    # Для промежуточных значений используем интерполяцию
-    # Находим ближайшие пресеты
-    sorted_presets = sorted(stars_map.keys())
-    
-    # Если запрошено меньше минимального пресета
-    if credits < sorted_presets[0]:
-        return int(credits * 400 / 150)
+    i = bisect_right(_SORTED_PRESETS, credits) - 1
     
-    # Если запрошено больше максимального пресета
-    if credits > sorted_presets[-1]:
-        return int(credits * 5150 / 2000)
+    # Если запрошено меньше минимального пресета — по курсу минимального (с округлением вниз)
+    if i < 0:
+        return credits * 400 // 150
     
-    # Находим два ближайших пресета для интерполяции
-    lower_preset = None
-    upper_preset = None
+    # Если запрошено не меньше максимального пресета — по курсу максимального (с округлением вниз)
+    if i == len(_SEGMENTS):
+        return credits * 5150 // 2000
     
-    for i, preset in enumerate(sorted_presets):
-        if preset <= credits:
-            lower_preset = preset
-        if preset >= credits and upper_preset is None:
-            upper_preset = preset
-            break
-    
-    # Если нашли оба пресета - интерполируем
-    if lower_preset and upper_preset:
-        lower_stars = stars_map[lower_preset]
-        upper_stars = stars_map[upper_preset]
-        
-        # Линейная интерполяция
-        ratio = (credits - lower_preset) / (upper_preset - lower_preset)
-        stars = lower_stars + (upper_stars - lower_stars) * ratio
-        return int(math.ceil(stars))
-    
-    # Fallback (не должно произойти)
-    return int(credits * 2.6)
-
+    # Линейная интерполяция между пресетами с округлением вверх, целочисленно
+    lo, hi, lo_stars, hi_stars = _SEGMENTS[i]
+    # ceil(a / b) для целых: -(-a // b), без float и math.ceil
+    extra = -(-(credits - lo) * (hi_stars - lo_stars) // (hi - lo))
+    return lo_stars + extra